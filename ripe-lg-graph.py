@@ -2,28 +2,56 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
+import colorsys
+import dns.asyncresolver
 import dns.resolver
-import pydot
+import functools
+import io
 import ipaddress
+import itertools
+import orjson
 import os
-import random
-import requests
 import shutil
+import socket
+import subprocess
 import sys
+import tempfile
 import typing
 
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 from types import TracebackType
 
 looking_glass_url = "https://stat.ripe.net/data/looking-glass/data.json"
+asn_whois_server = ("whois.cymru.com", 43)
+dns_query_limit = 64
+dot_binary = shutil.which("dot")
 
 # See: https://stat.ripe.net/docs/data_api#RulesOfUsage
 sourceapp_name = "ripe-lg-graph_py"
 
+# shared by every RRC's graph
+node_label_cache = {}
+node_label_format = "<<TABLE CELLBORDER=\"0\" BORDER=\"0\" CELLPADDING=\"0\" CELLSPACING=\"0\"><TR><TD ALIGN=\"CENTER\">{}</TD></TR></TABLE>>"
+escape_table = str.maketrans({
+    "&": "&amp;",
+    ">": "&gt;",
+    "<": "&lt;"
+})
+
 # DON'T TOUCH IF YOU DON'T KNOW WHAT YOU'RE DOING
 target_folder = datetime.now().strftime("%Y-%m-%d %H%M%S")
 target = ""
+resolve_asn_names = True
+
+# shared session, created on first use by get_session()
+session = None
+
+# filled by warm_as_names for every ASN in the paths, failed lookups included
+asn_info = {}
 
 
 class AddressOrPrefixNotFoundError(Exception):
@@ -81,7 +109,27 @@ def form_params(resource_param:str="") -> typing.Dict[str, str]:
     return params
 
 
-def get_rrc_data(address_prefix:str, rrc_list:typing.Union[str, typing.List[str]]="") -> typing.Dict[str, typing.Dict[str, typing.Union[str, typing.List[str]]]]:
+@functools.lru_cache(maxsize=None)
+def strip_prepends(as_path:str) -> typing.Tuple[str, ...]:
+    # the same path is usually seen by several peers and RRCs, so results are cached;
+    # ASNs are interned once here so every later dict lookup hits the same string objects
+    return tuple(sys.intern(as_number) for as_number, _ in itertools.groupby(as_path.split()))
+
+
+def get_session() -> CachedSession:
+    global session
+
+    # keeps the connection to RIPEstat alive between requests and reuses
+    # responses for the same resource for 5 minutes, kept in the user cache dir
+    if session is None:
+        session = CachedSession("ripe-lg-graph", use_cache_dir=True, expire_after=300, allowable_methods=("GET",))
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        session.headers["Accept-Encoding"] = "gzip"
+
+    return session
+
+
+def get_rrc_data(address_prefix:str, rrc_list:typing.Union[str, typing.List[str]]="") -> typing.Dict[str, typing.Dict[str, typing.Union[str, typing.List[typing.Tuple[str, ...]]]]]:
     parted_url = list(urlparse(looking_glass_url))
 
     query = dict(parse_qsl(parted_url[4]))
@@ -91,9 +139,9 @@ def get_rrc_data(address_prefix:str, rrc_list:typing.Union[str, typing.List[str]
     final_url = urlunparse(parted_url)
 
     print("Contacting RIPE NCC RIS looking glass...")
-    r = requests.get(final_url)
+    r = get_session().get(final_url, timeout=30)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
 
     if (data["messages"]):
         for message_array in data["messages"]:
@@ -121,15 +169,8 @@ def get_rrc_data(address_prefix:str, rrc_list:typing.Union[str, typing.List[str]
 
         for rrc_peer in rrc_dict["peers"]:
             as_path = rrc_peer["as_path"]
-            as_path_list = []
-
-            # this is done to strip prepends
-            for as_number in as_path.split(" "):
-                if ("".join(as_path_list[-1:]) == as_number):
-                    continue
-                as_path_list.append(as_number)
 
-            raw_returning_data[rrc_name]["paths"].append(" ".join(as_path_list))
+            raw_returning_data[rrc_name]["paths"].append(strip_prepends(as_path))
 
     if rrc_list == "":
         print("Processing all available RRCs...")
@@ -150,14 +191,60 @@ def get_rrc_data(address_prefix:str, rrc_list:typing.Union[str, typing.List[str]
     return returning_data
 
 
-def query_asn_info(asn:str) -> str:
-    try:
-        data = dns.resolver.resolve(f"AS{asn}.asn.cymru.com", "TXT").response.answer[0][0].to_text().replace("'","").replace('"','')
-    except:
-        return " "*5
+def query_bulk_asn_info(asns:typing.Iterable[str]) -> typing.Dict[str, typing.List[str]]:
+    query = "begin\nverbose\n" + "\n".join(f"AS{asn}" for asn in asns) + "\nend\n"
+    chunks = []
+
+    with socket.create_connection(asn_whois_server, timeout=10) as sock:
+        sock.sendall(query.encode())
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    returning_data = {}
+
+    # same layout as the DNS answer: AS | CC | Registry | Allocated | AS Name
+    for line in b"".join(chunks).decode("utf-8", "replace").splitlines():
+        fields = [ field.strip() for field in line.split("|") ]
+        if fields[0].isdigit():
+            returning_data[fields[0]] = fields
+
+    return returning_data
+
+
+def parse_asn_answer(answer:dns.resolver.Answer) -> typing.List[str]:
+    data = answer.response.answer[0][0].to_text().replace("'","").replace('"','')
     return [ field.strip() for field in data.split("|") ]
 
 
+async def query_asn_infos_async(asns:typing.Iterable[str]) -> typing.Dict[str, typing.Union[str, typing.List[str]]]:
+    async_resolver = dns.asyncresolver.Resolver()
+    # keeps a slow nameserver from stalling a lookup for the default 30s
+    async_resolver.lifetime = 2.0
+
+    # keeps a failed bulk query from firing thousands of lookups at once
+    query_limit = asyncio.Semaphore(dns_query_limit)
+
+    async def resolve(asn):
+        async with query_limit:
+            return await async_resolver.resolve(f"AS{asn}.asn.cymru.com", "TXT")
+
+    asns = list(asns)
+    answers = await asyncio.gather(*(resolve(asn) for asn in asns), return_exceptions=True)
+
+    returning_data = {}
+
+    for asn, answer in zip(asns, answers):
+        if isinstance(answer, Exception):
+            returning_data[asn] = " "*5
+        else:
+            returning_data[asn] = parse_asn_answer(answer)
+
+    return returning_data
+
+
 def get_as_name(_as:str) -> str:
     if not _as:
         return "AS?????"
@@ -165,113 +252,193 @@ def get_as_name(_as:str) -> str:
     if not _as.isdigit():
         return _as.strip()
 
-    name = query_asn_info(_as)[-1].replace(" ","\r",1)
+    if not resolve_asn_names:
+        return f"AS{_as}"
+
+    name = asn_info.get(_as, " "*5)[-1].replace(" ","\r",1)
     return f"AS{_as} | {name}"
 
 
-def make_bgpmap(rrc:str, rrc_data_dict:typing.Dict[str, typing.Union[str, typing.List[str]]]) -> True:
+def warm_as_names(rrc_path_data:typing.Dict[str, typing.Dict[str, typing.Union[str, typing.List[typing.Tuple[str, ...]]]]]) -> None:
+    unique_asns = {
+        _as
+        for rrc_data_dict in rrc_path_data.values()
+        for path in rrc_data_dict["paths"]
+        for _as in path
+        if _as.isdigit()
+    }
+
+    print(f"Resolving {len(unique_asns)} AS names...")
+    try:
+        asn_info.update(query_bulk_asn_info(unique_asns))
+    except OSError as e:
+        print(f"Bulk whois query failed ({e}), falling back to DNS...")
+
+    # whatever the bulk query missed is looked up over DNS, all at once
+    missing_asns = unique_asns - asn_info.keys()
+    if missing_asns:
+        asn_info.update(asyncio.run(query_asn_infos_async(missing_asns)))
+
+
+def escape(label:str) -> str:
+    return label.translate(escape_table)
+
+
+def quote(value:str) -> str:
+    # HTML-like labels go out as is
+    if value.startswith("<") and value.endswith(">"):
+        return value
+    return '"' + value.replace('"', '\\"') + '"'
+
+
+def make_node_label(label:str) -> str:
+    return node_label_format.format(escape(label).replace("\r", "<BR/>"))
+
+
+def make_bgpmap(rrc:str, rrc_data_dict:typing.Dict[str, typing.Union[str, typing.List[typing.Tuple[str, ...]]]]) -> typing.Tuple[str, str]:
     rrc_full = f"{rrc} - {rrc_data_dict['location']}"
     print(f"Now processing: {rrc_full}")
 
-    graph = pydot.Dot('BGPMAP', graph_type='digraph')
-
+    # nodes and edges are collected as plain dicts first, DOT statements are written once at the end
     nodes = {}
     edges = {}
 
-    def escape(label):
-        label = label.replace("&", "&amp;")
-        label = label.replace(">", "&gt;")
-        label = label.replace("<", "&lt;")
-        return label
-
     def add_node(_as, **kwargs):
-        carriage_return = "\r"
-
         if _as not in nodes:
-            kwargs["label"] = f"<<TABLE CELLBORDER=\"0\" BORDER=\"0\" CELLPADDING=\"0\" CELLSPACING=\"0\"><TR><TD ALIGN=\"CENTER\">{escape(kwargs.get('label', get_as_name(_as))).replace(carriage_return,'<BR/>')}</TD></TR></TABLE>>"
-            nodes[_as] = pydot.Node(_as, style="filled", fontsize="10", **kwargs)
-            graph.add_node(nodes[_as])
+            nodes[_as] = kwargs
 
         return nodes[_as]
 
-    def add_edge(_previous_as, _as, **kwargs):
-        kwargs["splines"] = "true"
-        force = kwargs.get("force", False)
-
+    def add_edge(_previous_as, _as, label="", bold=False, color=None):
         edge_tuple = (_previous_as, _as)
 
-        if force or edge_tuple not in edges:
-            edge = pydot.Edge(*edge_tuple, **kwargs)
-            graph.add_edge(edge)
-            edges[edge_tuple] = edge
-        elif "label" in kwargs and kwargs["label"]:
-            e = edges[edge_tuple]
-            label_without_star = kwargs["label"].replace("*", "")
+        if edge_tuple not in edges:
+            edges[edge_tuple] = {
+                "labels": [],
+                "bold": False,
+                "color": None
+            }
 
-            if e.get_label() is not None:
-                labels = e.get_label().split("\r")
-            else:
-                return edges[edge_tuple]
+        edge = edges[edge_tuple]
 
-            if "%s*" % label_without_star not in labels:
-                labels = [ kwargs["label"] ]  + [ l for l in labels if not l.startswith(label_without_star) ]
-                labels = sorted(labels, key=lambda x: x.endswith("*") and -1 or 1)
+        if label:
+            label_without_star = label.replace("*", "")
 
-                label = escape("\r".join(labels))
-                e.set_label(label)
+            if f"{label_without_star}*" not in edge["labels"]:
+                edge["labels"] = [ label ] + [ l for l in edge["labels"] if l.replace("*", "") != label_without_star ]
 
-        return edges[edge_tuple]
+        if bold:
+            edge["bold"] = True
+        elif not edge["bold"]:
+            edge["color"] = color
+
+        return edge
 
     add_node(rrc_full, label=rrc_full, shape="box", fillcolor="#F5A9A9")
 
     previous_as = None
     first = True
 
-    for asmap in rrc_data_dict["paths"]:
+    # evenly spread hues, one per path
+    path_count = len(rrc_data_dict["paths"])
+    colors = [
+        "#%02x%02x%02x" % tuple(int(255 * c) for c in colorsys.hls_to_rgb(i / path_count, 0.5, 0.8))
+        for i in range(path_count)
+    ]
+
+    for path_index, hops in enumerate(rrc_data_dict["paths"]):
         previous_as = rrc_full
-        color = "#%x" % random.randint(0, 16777215)
+        color = colors[path_index]
 
-        hop = False
-        hop_label = ""
+        last_hop = len(hops) - 1
 
-        for _as in asmap.split(" "):
+        for hop, _as in enumerate(hops):
+            is_last = (hop == last_hop)
 
-            if not hop:
-                hop = True
+            # only the first hop out of the RRC gets labelled
+            hop_label = ""
+            if hop == 0:
                 hop_label = _as
                 if first:
                     hop_label = hop_label + "*"
 
-            if (_as == asmap[-1]):
+            if is_last:
                 add_node(_as, fillcolor="#F5A9A9", shape="box")
             else:
                 add_node(_as, fillcolor=(first and "#F5A9A9" or "white"))
 
-            if hop_label:
-                edge = add_edge(nodes[previous_as], nodes[_as], label=hop_label, fontsize="7")
-            else:
-                edge = add_edge(nodes[previous_as], nodes[_as], fontsize="7")
-
-            hop_label = ""
-
-            if (first or _as == asmap[-1]):
-                edge.set_style("bold")
-                edge.set_color("red")
-            elif edge.get_style() != "bold":
-                edge.set_style("dashed")
-                edge.set_color(color)
+            add_edge(previous_as, _as, label=hop_label, bold=(first or is_last), color=color)
 
             previous_as = _as
 
         first = False
 
     add_node("Prefix", label=target, fillcolor="#F5A9A9", shape="box")
-    final_edge = add_edge(nodes[_as], nodes["Prefix"], fontsize="7")
-    final_edge.set_style("bold")
-    final_edge.set_color("red")
+    add_edge(_as, "Prefix", bold=True)
+
+    # DOT source is written out directly, no need for an object per node and edge
+    dot_source = io.StringIO()
+    dot_source.write("digraph BGPMAP {\n")
+
+    def write_statement(statement, **kwargs):
+        attributes = ", ".join(f"{key}={quote(value)}" for key, value in kwargs.items())
+        dot_source.write(f"{statement} [{attributes}];\n")
 
-    graph.write(f"./output/{target_folder}/png/{rrc_full}.png", format="png")
-    graph.write(f"./output/{target_folder}/svg/{rrc_full}.svg", format="svg")
+    for _as, kwargs in nodes.items():
+        if "label" in kwargs:
+            label = make_node_label(kwargs.pop("label"))
+        else:
+            # AS nodes look the same in every RRC's graph
+            if _as not in node_label_cache:
+                node_label_cache[_as] = make_node_label(get_as_name(_as))
+            label = node_label_cache[_as]
+
+        write_statement(quote(_as), style="filled", fontsize="10", label=label, **kwargs)
+
+    for edge_tuple, edge in edges.items():
+        kwargs = {
+            "fontsize": "7",
+            "splines": "true"
+        }
+
+        if edge["labels"]:
+            labels = sorted(edge["labels"], key=lambda x: x.endswith("*") and -1 or 1)
+            kwargs["label"] = escape("\r".join(labels))
+
+        if edge["bold"]:
+            kwargs["style"] = "bold"
+            kwargs["color"] = "red"
+        else:
+            kwargs["style"] = "dashed"
+            kwargs["color"] = edge["color"]
+
+        write_statement(" -> ".join(quote(_as) for _as in edge_tuple), **kwargs)
+
+    dot_source.write("}\n")
+
+    return rrc_full, dot_source.getvalue()
+
+
+def render_bgpmaps(bgpmaps:typing.Dict[str, str]) -> True:
+    print("Rendering graphs...")
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        source_path = os.path.join(temp_folder, "bgpmaps.gv")
+
+        with open(source_path, "w", encoding="utf-8") as source_file:
+            source_file.writelines(bgpmaps.values())
+
+        # all graphs go through a single dot run, -O names the outputs
+        # bgpmaps.gv.png, bgpmaps.gv.2.png, bgpmaps.gv.3.png and so on.
+        # both formats stay in the same run so each graph is laid out only once,
+        # a dot process per format would repeat the layout for every graph
+        # nothing sensitive is open, so skip closing every inherited fd on spawn
+        subprocess.run([dot_binary, "-Tpng", "-Tsvg", "-O", source_path], check=True, close_fds=False)
+
+        for index, rrc_full in enumerate(bgpmaps):
+            graph_suffix = f".{index + 1}" if index else ""
+            for output_format in ("png", "svg"):
+                shutil.move(f"{source_path}{graph_suffix}.{output_format}", f"./output/{target_folder}/{output_format}/{rrc_full}.{output_format}")
 
     return True
 
@@ -291,20 +458,32 @@ if __name__ == "__main__":
         "--rrc", help="ID(s) of the RRC for graphing, process all if none specified (comma seperated if multiple)", type=str, required=False, default=""
     )
 
+    parser.add_argument(
+        "--no-asn-names", help="Only show AS numbers, skips looking up AS names", action="store_true"
+    )
+
     parser.add_argument(
         "address_prefix", help="IP prefix or address, will not search for the nearest announced object.", type=str
     )
 
     args = parser.parse_args()
 
+    resolve_asn_names = not args.no_asn_names
+
+    # fail before any of the network work if there is nothing to render with
+    if dot_binary is None:
+        raise FileNotFoundError("Graphviz's dot executable is not found in PATH.")
+
     if (is_valid(args.address_prefix)):
         rrc_path_data = get_rrc_data(args.address_prefix, process_rrc_options(args.rrc))
+        if resolve_asn_names:
+            warm_as_names(rrc_path_data)
 
         os.makedirs(f"./output/{target_folder}/png")
         os.makedirs(f"./output/{target_folder}/svg")
 
-        for rrc, rrc_data_dict in rrc_path_data.items():
-            make_bgpmap(rrc, rrc_data_dict)
+        bgpmaps = dict(make_bgpmap(rrc, rrc_data_dict) for rrc, rrc_data_dict in rrc_path_data.items())
+        render_bgpmaps(bgpmaps)
 
         print("\nDone!")
     else: